@@ -1,35 +1,67 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import numpy as np
 import matplotlib.pyplot as plt
-import svgwrite
+from matplotlib.collections import LineCollection
+from matplotlib.colors import to_rgba_array
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Number of set bits in a 4-bit mask, and the position of its n-th set bit
+_POPCOUNT = np.array([bin(m).count('1') for m in range(16)], np.intp)
+_NTH_BIT = np.array([[k for k in range(4) if m >> k & 1] + [0]*(4 - _POPCOUNT[m])
+                     for m in range(16)], np.intp)
+# Directions without a bond for each 4-bit bond mask
+_NOBOND_TABLE = [[k for k in range(4) if not m >> k & 1] for m in range(16)]
+
+def _step_cells(color, active, empty, bonds, cells, nbr, up, down, grow_prop,
+                choice, probs, out_cells):
+    '''Grow the given cells one at a time, as in the original per-cell
+    loop. choice and probs hold one uniform draw per cell for picking a
+    neighbor and deciding to grow. Cells that are still active are written
+    to out_cells, which must hold 2*len(cells) entries, and their number
+    is returned.'''
+    n = 0
+    for i in range(cells.size):
+        idx = cells[i]
+        # Check if any neighbor cells are free, bit k for direction k
+        free = 0
+        for k in range(4):
+            if empty[idx + nbr[k]]:
+                free |= 1 << k
+        # Check for bonds blocking free neighbors
+        upper_bonds = bonds[idx + up]
+        lower_bonds = bonds[idx + down]
+        free &= ~(upper_bonds >> 3 & 0b0001 | upper_bonds >> 1 & 0b0010
+                  | lower_bonds << 1 & 0b0100 | lower_bonds << 3 & 0b1000)
+        if free == 0:
+            active[idx] = False
+            continue
+        # Choose an neighbor
+        nb_idx = _NTH_BIT[free, int(choice[i] * _POPCOUNT[free])]
+        if probs[i] < grow_prop:
+            newlink = idx + nbr[nb_idx]
+            color[newlink] = color[idx]
+            active[newlink] = True
+            empty[newlink] = False
+            bonds[newlink] |= 1 << (nb_idx+2) % 4
+            bonds[idx] |= 1 << nb_idx
+            out_cells[n] = newlink
+            n += 1
+        out_cells[n] = idx
+        n += 1
+    return n
+
+_step_nb = njit(cache=True)(_step_cells) if njit is not None else None
 
-class Dot:
-    '''Class containing data for a single dot in the puzzle.
-    Initiate with coordinates i,j'''
-    def __init__(self,i,j):
-        self.color = None
-        self.active = True
-        self.empty = True
-        self.coords = (i,j)
-        self.free_neighbors = []
-        self.bonds = []
-        self.neighbors = [tuple(np.array(self.coords) + shift)
-                          for shift in
-            [(1, 1),(-1, 1),(-1, -1),(1, -1)]]
-    
-    def __repr__(self):
-        return f'coords: {self.coords}, color: {self.color}\nactive: {self.active}, empty: {self.empty}'
-    
-def get_color(Dot):
-    if Dot.empty:
-        if not Dot.active:
-            return -1
-        else:
-            return 0
-    return Dot.color
-    
 class Jigsaw:
     '''Class for a random walk jigsaw
 
+    The grid is stored as flat arrays, one entry per cell, with the
+    cell at (i,j) found at index i*res + j.
+
     Parameters
     ----------
     res : int
@@ -41,32 +73,61 @@ class Jigsaw:
     def __init__(self,res=50,bordertype='rect'):
         self.res = res + 2
         self.num_pieces = 0
-        self.jigsaw = np.zeros((self.res,self.res),dtype=Dot)
-        for i in range(self.res):
-            for j in range(self.res):
-                self.jigsaw[i,j] = Dot(i,j)
-        self.active_cells = []
+        self.color = np.zeros(self.res*self.res, np.int32)
+        self.active = np.ones(self.res*self.res, bool)
+        self.empty = np.ones(self.res*self.res, bool)
+        # Bit k is set when the cell is bonded to its neighbor in direction k
+        self.bonds = np.zeros(self.res*self.res, np.uint8)
+        # Linear offsets to the diagonal neighbors (1,1),(-1,1),(-1,-1),(1,-1)
+        self._nbr = np.array([self.res+1, -self.res+1, -self.res-1, self.res-1], np.intp)
+        # Linear offsets to the cells above (0,1) and below (0,-1)
+        self._up = 1
+        self._down = -1
+        self.active_idx = np.empty(0, np.int32)
+        self._seed_coords = np.empty((0,2), int)
         if bordertype=='circ':
             self.circle_mask()
         else:
             self.border_mask()
         
+    @classmethod
+    def batch(cls, n, num_pieces=11, min_dist=1, steps=500, grow_prop=1,
+              seed=None, max_workers=None, **kwargs):
+        '''Grow n independent jigsaws in parallel processes.
+
+        Each jigsaw is made with Jigsaw(**kwargs), seeded with num_pieces
+        pieces at min_dist and grown for up to steps steps with grow_prop.
+        Pass seed for reproducible results. Returns a list of jigsaws.
+'''
+        seeds = np.random.SeedSequence(seed).generate_state(n)
+        with ProcessPoolExecutor(max_workers) as pool:
+            return list(pool.map(_grow_jigsaw, seeds, repeat(kwargs), repeat(num_pieces),
+                                 repeat(min_dist), repeat(steps), repeat(grow_prop)))
+        
     def border_mask(self):
         '''Creates a square border on the outermost rows/columns'''
-        for i in range(self.res):
-            for x,y in [(i,0),(i,-1),(0,i),(-1,i)]:
-                self.jigsaw[x,y].active = False
-                self.jigsaw[x,y].empty = False
+        for grid in [self.active, self.empty]:
+            grid = grid.reshape(self.res,self.res)
+            grid[0,:] = grid[-1,:] = grid[:,0] = grid[:,-1] = False
                 
     def circle_mask(self):
         '''Create a circular border'''
-        for i in range(self.res):
-            for j in range(self.res):
-                x = i-self.res/2 + 1/2
-                y = j-self.res/2 + 1/2
-                if np.sqrt(x**2 + y**2) > self.res/2 - 1.1:
-                    self.jigsaw[i,j].active = False
-                    self.jigsaw[i,j].empty = False
+        xs2 = (np.arange(self.res) - self.res/2 + 1/2)**2
+        thr2 = (self.res/2 - 1.1)**2
+        mask = (xs2[:,None] + xs2[None,:] > thr2).ravel()
+        self.active[mask] = False
+        self.empty[mask] = False
+        
+    def get_color(self,i,j):
+        '''Color of the cell at (i,j). Empty cells give 0, or -1 if
+        they are outside the border.'''
+        idx = i*self.res + j
+        if self.empty[idx]:
+            if not self.active[idx]:
+                return -1
+            else:
+                return 0
+        return self.color[idx]
         
     def initiate_pieces(self,num_pieces=11, min_dist=1):
         '''Initiate a number of pieces by randomly filling empty squares.
@@ -76,74 +137,86 @@ class Jigsaw:
         self.num_pieces = num_pieces
         
         for c in range(1, self.num_pieces+1):
-            d = Dot(0,0)
-            d.empty=False
-            n = 0
-            while not (d.empty and d.active) and n<1000:
-                n += 1
-                index = tuple(np.random.choice(self.res, 2))
-                too_close = False
-                for p in self.active_cells:
-                    dist = np.sqrt(np.sum((np.array(index) - np.array(p))**2))
-                    if dist < min_dist:
-                        too_close = True
-                        break
-                if too_close:
-                    continue
-                d = self.jigsaw[index]
-                if d.empty and d.active:
-                    d.color = c
-                    d.empty = False
-                    self.active_cells.append(d.coords)
+            candidates = np.random.randint(0, self.res, (1000, 2))
+            for index in candidates.tolist():
+                if self._seed_coords.size:
+                    d2 = ((self._seed_coords - index)**2).sum(1)
+                    if (d2 < min_dist*min_dist).any():
+                        continue
+                idx = index[0]*self.res + index[1]
+                if self.empty[idx] and self.active[idx]:
+                    self.color[idx] = c
+                    self.empty[idx] = False
+                    self.active_idx = np.append(self.active_idx, np.int32(idx))
+                    self._seed_coords = np.vstack([self._seed_coords, index])
                     break
                     
+    def _blocked(self, idx):
+        '''Directions out of the cells idx that are crossed by a bond, as
+        a 4-bit mask. A bond 3 above blocks direction 0, 2 above blocks 1,
+        1 below blocks 2 and 0 below blocks 3.'''
+        upper_bonds = self.bonds[idx + self._up]
+        lower_bonds = self.bonds[idx + self._down]
+        return (upper_bonds >> 3 & 0b0001 | upper_bonds >> 1 & 0b0010
+                | lower_bonds << 1 & 0b0100 | lower_bonds << 3 & 0b1000)
+                    
     def step(self, grow_prop=1, verbose=False):
-        '''Grow all active, occupied cells with probability grow_prop'''
-        if verbose: print(f'Number of active cells: {len(self.active_cells)}')
-        new_active_cells = []
-        np.random.shuffle(self.active_cells)
-        for coo in self.active_cells:
-            d = self.jigsaw[coo]
-            # Check if any neighbor cells are free
-            d.free_neighbors = []
-            for i,n in enumerate(d.neighbors):
-                if self.jigsaw[n].empty:
-                    d.free_neighbors.append(i)
-            d.free_neighbors = np.array(d.free_neighbors)
-            # Check for bonds blocking free neighbors
-            upper_n = self.jigsaw[tuple(d.coords + np.array([0,1]))]
-            lower_n = self.jigsaw[tuple(d.coords + np.array([0,-1]))]
-            if 3 in upper_n.bonds:
-                d.free_neighbors = d.free_neighbors[d.free_neighbors != 0]
-            if 2 in upper_n.bonds:
-                d.free_neighbors = d.free_neighbors[d.free_neighbors != 1]
-            if 1 in lower_n.bonds:
-                d.free_neighbors = d.free_neighbors[d.free_neighbors != 2]
-            if 0 in lower_n.bonds:
-                d.free_neighbors = d.free_neighbors[d.free_neighbors != 3]
-            if d.free_neighbors.size == 0:
-                d.active = False
-                continue
-            # Choose an neighbor
-            nb_idx = np.random.choice(d.free_neighbors, 1)[0]
-            if np.random.rand() < grow_prop:
-                newlink = self.jigsaw[d.neighbors[nb_idx]]
-                newlink.color = d.color
-                newlink.active = True
-                newlink.empty = False
-                newlink.bonds.append((nb_idx+2) % 4)
-                d.bonds.append(nb_idx)
-                new_active_cells.append(d.neighbors[nb_idx])
-                
-            new_active_cells.append(coo)
-        self.active_cells = new_active_cells
+        '''Grow all active, occupied cells with probability grow_prop
+
+        If numba is installed, cells are grown one at a time by a compiled
+        loop. Otherwise diagonal moves preserve the parity of i+j, and a move can only be
+        blocked by bonds on cells of the opposite parity. Each parity
+        class is therefore updated as one vectorized batch. Cells competing
+        for the same free neighbor are resolved in shuffled order; the
+        losers stay active and try again next step.
+        '''
+        if verbose: print(f'Number of active cells: {self.active_idx.size}')
+        cells = self.active_idx[np.random.permutation(self.active_idx.size)]
+        choice = np.random.random(cells.size)
+        probs = np.random.random(cells.size)
+        # Surviving cells plus at most one new cell each
+        out_cells = np.empty(2*cells.size, np.int32)
+        if _step_nb is not None:
+            n = _step_nb(self.color, self.active, self.empty, self.bonds, cells,
+                         self._nbr, self._up, self._down, grow_prop,
+                         choice, probs, out_cells)
+            self.active_idx = out_cells[:n]
+            return
+        n = 0
+        parity = (cells // self.res + cells % self.res) % 2
+        for p in [0, 1]:
+            sel = parity == p
+            idx, nb_choice, grow = cells[sel], choice[sel], probs[sel] < grow_prop
+            # Check if any neighbor cells are free, bit k for direction k
+            free = np.packbits(self.empty[idx[:,None] + self._nbr], axis=1, bitorder='little')[:,0]
+            free &= ~self._blocked(idx)
+            stuck = free == 0
+            self.active[idx[stuck]] = False
+            idx, free = idx[~stuck], free[~stuck]
+            nb_choice, grow = nb_choice[~stuck], grow[~stuck]
+            out_cells[n:n+idx.size] = idx
+            n += idx.size
+            # Choose a free neighbor
+            idx, free, nb_choice = idx[grow], free[grow], nb_choice[grow]
+            nb_idx = _NTH_BIT[free, (nb_choice * _POPCOUNT[free]).astype(np.intp)]
+            newlink = idx + self._nbr[nb_idx]
+            _, first = np.unique(newlink, return_index=True)
+            idx, nb_idx, newlink = idx[first], nb_idx[first], newlink[first]
+            self.color[newlink] = self.color[idx]
+            self.active[newlink] = True
+            self.empty[newlink] = False
+            self.bonds[newlink] |= (1 << (nb_idx+2) % 4).astype(np.uint8)
+            self.bonds[idx] |= (1 << nb_idx).astype(np.uint8)
+            out_cells[n:n+newlink.size] = newlink
+            n += newlink.size
+        self.active_idx = out_cells[:n]
                 
                 
     def steps(self,steps=500, **kwargs):
         '''Loop function for taking multiple steps'''
         for _ in range(steps):
             self.step(**kwargs)
-            if not self.active_cells:
+            if not self.active_idx.size:
                 print(f'Converged at step {_}')
                 break
         else:
@@ -153,30 +226,48 @@ class Jigsaw:
         '''Fill in the rest of the puzzle with what should be
         parts of the border. This helps when exporting.
         '''
-        for i in range(self.res):
-            for j in range(self.res):
-                d = self.jigsaw[(i,j)]
-                if d.empty and d.active:
-                    d.empty = False
-                    d.color = 1000
-                    self.active_cells.append((i,j))
-                    self.steps(1000)
+        leftover = np.flatnonzero(self.empty & self.active)
+        while leftover.size:
+            # Label each connected patch of leftover cells with its lowest
+            # index, so every patch is seeded once where a scan would find it
+            label = np.full(self.res*self.res, self.res*self.res)
+            label[leftover] = leftover
+            blocked = self._blocked(leftover)[:,None] >> np.arange(4, dtype=np.uint8) & 1
+            while True:
+                nbr_label = np.where(blocked, label.size, label[leftover[:,None] + self._nbr])
+                new_label = label[np.minimum(label[leftover], nbr_label.min(1))]
+                if (new_label == label[leftover]).all():
+                    break
+                label[leftover] = new_label
+            seeds = leftover[label[leftover] == leftover]
+            self.empty[seeds] = False
+            self.color[seeds] = 1000
+            self.active_idx = np.concatenate([self.active_idx, seeds.astype(np.int32)])
+            self.steps(1000)
+            leftover = np.flatnonzero(self.empty & self.active)
                 
     def show(self):
         '''Show puzzle'''
+        palette = to_rgba_array([f'C{c}' for c in range(9)])
         plt.figure(figsize=(7,7))
-        plt.subplot(aspect=1)
-        for i in range(self.res):
-            for j in range(self.res):
-                d = self.jigsaw[(i,j)]
-                if 2 in d.bonds:
-                    plt.plot([i, i-1], [j, j-1],f'C{d.color % 9}o-')
-                if 3 in d.bonds:
-                    plt.plot([i, i+1], [j, j-1],f'C{d.color % 9}o-')
+        ax = plt.subplot(aspect=1)
+        # Every bond is drawn once, from its upper end
+        segs, colors = [], []
+        for bond, di in [(0b0100, -1), (0b1000, 1)]:
+            i, j = np.divmod(np.flatnonzero(self.bonds & bond), self.res)
+            segs.append(np.stack([np.c_[i, j], np.c_[i+di, j-1]], axis=1))
+            colors.append(palette[self.color[i*self.res + j] % 9])
+        ax.add_collection(LineCollection(np.concatenate(segs), colors=np.concatenate(colors)))
+        i, j = np.divmod(np.flatnonzero(self.bonds), self.res)
+        ax.scatter(i, j, c=palette[self.color[i*self.res + j] % 9])
+        ax.autoscale_view()
         plt.show()
     
+    # Signs of the x and y shifts and the sweep flag for each quadrant
+    _ARC_SHIFTS = ((1, 1, 0), (-1, 1, 1), (-1, -1, 0), (1, -1, 1))
+
     def _draw_arc(self,x,y,r,quad,stroke_width=4):
-        '''Returns an svg quarter circle using the svgwrite module
+        '''Returns an svg quarter circle path element
 
         Parameters
         ----------
@@ -185,21 +276,10 @@ class Jigsaw:
         quad : the quadrant of the quarter circle
         stroke_width : width of svg stroke
         '''
-        if quad in [0, 1]:
-            yshift = r
-        else:
-            yshift = -r
-        if quad in [0,3]:
-            xshift = r
-        else:
-            xshift = -r
-        flip = 0
-        if quad in [1,3]:
-            flip = 1
-        return svgwrite.Drawing().path(d=f'M {x} {y+yshift} a {r},{r} 0 0,{flip} {xshift} {-yshift}',
-                                      stroke='black',
-                                      fill='none',
-                                      style=f'stroke-width:{stroke_width}')
+        xsign, ysign, flip = self._ARC_SHIFTS[quad]
+        xshift, yshift = xsign*r, ysign*r
+        return (f'<path d="M {x} {y+yshift} a {r},{r} 0 0,{flip} {xshift} {-yshift}" '
+                f'fill="none" stroke="black" style="stroke-width:{stroke_width}" />')
     
     def export(self,filename='out.svg', scale=15, **kwargs):
         '''Export puzzle as svg
@@ -209,40 +289,42 @@ class Jigsaw:
         filename : filename to save svg file to
         scale : diameter of circles in px
         stroke_width : width of stroke in svg
+
+        Returns the svg document as a string.
         '''
         colormap = plt.cm.get_cmap('jet',self.num_pieces)
-        svg = svgwrite.Drawing(filename=filename, size=(scale*self.res,scale*self.res))
-        g_circles = svg.add(svg.g(id='circles'))
-        g_strokes = svg.add(svg.g(id='strokes'))
-        for i in range(self.res):
-            for j in range(self.res):
-                d = self.jigsaw[(i,j)]
-                if not d.color:
-                    continue
-                nobonds = set(range(4)) - set(d.bonds)
-                for quad in nobonds:
-                    g_strokes.add(self._draw_arc(i*scale,j*scale, scale/2, quad, **kwargs))
-                if d.color == 1000:
-                    fill = '#FFFFFF'
-                else:
-                    fill = cmap_to_hex(colormap(d.color))
-                g_circles.add(svg.circle((scale*i,scale*j),scale/2.1,
-                                   fill=fill))
-        svg.save()
+        hex_colors = [cmap_to_hex(colormap(c)) for c in range(self.num_pieces+1)]
+        circles = []
+        strokes = []
+        for idx in np.flatnonzero(self.color).tolist():
+            i, j = divmod(idx, self.res)
+            color = self.color[idx]
+            for quad in _NOBOND_TABLE[self.bonds[idx]]:
+                strokes.append(self._draw_arc(i*scale,j*scale, scale/2, quad, **kwargs))
+            if color == 1000:
+                fill = '#FFFFFF'
+            else:
+                fill = hex_colors[color]
+            circles.append(f'<circle cx="{scale*i}" cy="{scale*j}" fill="{fill}" r="{scale/2.1}" />')
+        size = scale*self.res
+        svg = ''.join([
+            '<?xml version="1.0" encoding="utf-8" ?>\n',
+            f'<svg baseProfile="full" height="{size}" version="1.1" width="{size}" ',
+            'xmlns="http://www.w3.org/2000/svg" xmlns:ev="http://www.w3.org/2001/xml-events" ',
+            'xmlns:xlink="http://www.w3.org/1999/xlink"><defs />',
+            '<g id="circles">', *circles, '</g>',
+            '<g id="strokes">', *strokes, '</g>',
+            '</svg>'])
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write(svg)
         print(f'File saved to {filename}')
         return svg
     
     def count(self):
         '''Show sizes of puzzle pieces'''
-        counts = {}
-        for x in range(self.res):
-            for y in range(self.res):
-                d = self.jigsaw[x,y]
-                try:
-                    counts[d.color] += 1
-                except:
-                    counts[d.color] = 1
-        del counts[None]
+        colors, sizes = np.unique(self.color, return_counts=True)
+        counts = dict(zip(colors.tolist(), sizes.tolist()))
+        del counts[0]
         print('    Piece   Size')
         for p,n in sorted(counts.items()):
             print(f'{p:9} {n:6}')
@@ -254,3 +336,11 @@ class Jigsaw:
 def cmap_to_hex(tup):
     '''Convert rgb from (0.5,0.5,0.5) format to hex'''
     return '#%02x%02x%02x' % tuple([int(t*255) for t in tup[:-1]])
+
+def _grow_jigsaw(seed, kwargs, num_pieces, min_dist, steps, grow_prop):
+    '''Worker for Jigsaw.batch'''
+    np.random.seed(seed)
+    j = Jigsaw(**kwargs)
+    j.initiate_pieces(num_pieces, min_dist=min_dist)
+    j.steps(steps, grow_prop=grow_prop)
+    return j